@@ -12,17 +12,109 @@ Key findings:
 """
 
 import argparse
-import fcntl
+import atexit
+import itertools
 import json
 import os
+import re
 import sqlite3
 import sys
+import tempfile
 import urllib.parse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
-LOCK_FILE = '/tmp/export-cursor.lock'
+try:
+    import orjson  # Optional: 3-5x faster JSON decoding of bubble blobs
+except ImportError:
+    orjson = None
+
+
+def json_loads(s: Any) -> Any:
+    """Decode JSON with orjson when it is installed, else with the stdlib.
+
+    orjson rejects some input the stdlib accepts (lone surrogate escapes,
+    NaN, Infinity); those are decoded again with json.loads rather than
+    dropped.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(s)
+
+
+# Fixed /tmp on POSIX: macOS's per-user $TMPDIR is often unset under cron,
+# which would give interactive and cron runs different locks
+LOCK_FILE = os.path.join(tempfile.gettempdir() if sys.platform == 'win32' else '/tmp', 'export-cursor.lock')
+
+# An empty lock file may belong to a process that has created it but not yet
+# written its PID; only treat it as stale once it is older than this (seconds)
+LOCK_PID_WRITE_GRACE = 10
+
+# Read-only connection tuning: 256MB page cache, 256MB mmap, in-memory temp
+# tables. query_only guards against accidental writes to Cursor's databases.
+# The page cache only grows as pages are read, so small workspace DBs don't
+# pay for it. journal_mode is left alone: a mode=ro connection can't change it.
+READONLY_PRAGMAS = (
+    'query_only=1',
+    'cache_size=-262144',
+    'mmap_size=268435456',
+    'temp_store=MEMORY',
+)
+
+# The global state.vscdb holds every bubble and can run to hundreds of MB;
+# map up to 1GB of it so the bubble scan reads straight from the page cache
+GLOBAL_DB_MMAP_SIZE = 1024 * 1024 * 1024
+
+# Per-output-directory record of each thread's lastUpdatedAt at export time
+# and of the workspace databases read, so unchanged ones can be skipped
+EXPORT_MANIFEST_NAME = '.export-cache.json'
+
+# Filename-unsafe characters for slugify_title(), applied in a single pass
+SLUG_TRANSLATION = str.maketrans({
+    '/': '-', '\\': '-', ':': '-', '*': '-', '?': '-',
+    '"': None, '<': '-', '>': '-', '|': '-', ' ': '-'
+})
+SLUG_DASHES_RE = re.compile(r'-+')
+
+# Shortest JSON object with a field ('{"a":0}'). Shorter request-context blobs
+# ('{}', 'null', '[]') render the same as a missing context, so they are
+# skipped without being decoded.
+MIN_JSON_OBJECT_LEN = 7
+
+# Below this many threads to export (or on a single CPU), formatting runs
+# in-process; starting workers and pickling bubbles to them costs more than it saves
+PARALLEL_EXPORT_MIN_THREADS = 4
+
+# Shared default for dict fields missing from a bubble, so `.get(k) or
+# EMPTY_DICT` doesn't allocate a fresh {} per lookup. Never mutate it.
+EMPTY_DICT: Dict[str, Any] = {}
+
+# Label written before a message's content, per get_message_role() result
+ROLE_PREFIX = {
+    'user': '**[User]** ',
+    'assistant': '**[Agent]** ',
+    'unknown': '**[Unknown]** ',
+}
+
+# Lines inserted between a user turn and an agent turn
+ROLE_SEPARATOR_LINES = ("", "---", "")
+
+# Fixed metadata block at the top of every exported conversation
+CONVERSATION_HEADER_TEMPLATE = '\n'.join((
+    "# {thread_name}",
+    "",
+    "**Exported:** {exported}  ",
+    "**Thread ID:** `{cid}`  ",
+    "**Created:** {created}  ",
+    "**Last Updated:** {updated}  ",
+    "**Messages:** {message_count}  ",
+))
 
 
 def get_cursor_base_path() -> str:
@@ -52,10 +144,42 @@ def get_workspace_db_paths() -> List[str]:
     return glob.glob(workspace_pattern)
 
 
-def connect_db_readonly(db_path: str) -> sqlite3.Connection:
-    """Connect to SQLite database in read-only mode."""
+def connect_db_readonly(db_path: str, mmap_size: int = None) -> sqlite3.Connection:
+    """Connect to SQLite database in read-only mode, tuned for bulk scans.
+
+    mmap_size overrides the default memory-mapped I/O window (in bytes).
+    """
     uri = f"file:{urllib.parse.quote(db_path)}?mode=ro"
-    return sqlite3.connect(uri, uri=True)
+    conn = sqlite3.connect(uri, uri=True)
+    for pragma in READONLY_PRAGMAS:
+        conn.execute(f"PRAGMA {pragma}")
+    if mmap_size is not None:
+        conn.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+    return conn
+
+
+def key_prefix_range(prefix: str) -> Tuple[str, str]:
+    """Return (low, high) bounds matching every key that starts with prefix.
+
+    `key >= low AND key < high` lets SQLite seek the index on `key`, which
+    LIKE cannot do (it is case-insensitive by default). Bumping the last
+    character gives the exclusive upper bound, e.g. 'bubbleId:x:' -> 'bubbleId:x;'.
+    """
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def bubble_sort_key(bubble: Dict[str, Any]) -> Tuple[int, Any]:
+    """Sort key for bubbles by createdAt, mirroring SQLite's type ordering.
+
+    Missing timestamps sort as 0; numbers sort before strings (ISO dates),
+    as they did with ORDER BY COALESCE(json_extract(value,'$.createdAt'),0).
+    """
+    created_at = bubble.get('createdAt')
+    if created_at is None:
+        return (0, 0)
+    if isinstance(created_at, (int, float)):
+        return (0, created_at)
+    return (1, str(created_at))
 
 
 def get_composer_threads(conn: sqlite3.Connection) -> List[Tuple[str, Dict[str, Any]]]:
@@ -71,11 +195,11 @@ def get_composer_threads(conn: sqlite3.Connection) -> List[Tuple[str, Dict[str,
             WHERE key LIKE 'composerData:%'
         """)
         
-        for cid, value_blob in cursor.fetchall():
+        for cid, value_blob in cursor:
             try:
                 if value_blob is None:
                     continue
-                data = json.loads(value_blob)
+                data = json_loads(value_blob)
                 threads.append((cid, data))
             except (json.JSONDecodeError, TypeError):
                 continue
@@ -92,7 +216,7 @@ def get_composer_threads(conn: sqlite3.Connection) -> List[Tuple[str, Dict[str,
         result = cursor.fetchone()
         if result and result[0]:
             try:
-                data = json.loads(result[0])
+                data = json_loads(result[0])
                 if isinstance(data, dict) and 'allComposers' in data:
                     for composer in data['allComposers']:
                         if isinstance(composer, dict) and 'composerId' in composer:
@@ -106,8 +230,44 @@ def get_composer_threads(conn: sqlite3.Connection) -> List[Tuple[str, Dict[str,
     return threads
 
 
-def get_all_composer_threads(verbose: bool = False) -> List[Tuple[str, Dict[str, Any]]]:
-    """Get all composer threads from global and workspace databases."""
+def get_db_stamp(db_path: str) -> List[int]:
+    """Return [mtime_ns, size] of a database and its WAL, to detect changes.
+
+    SQLite in WAL mode appends to state.vscdb-wal and only touches the main
+    file at checkpoint, so both files are included.
+    """
+    stamp = []
+    for path in (db_path, db_path + '-wal'):
+        try:
+            st = os.stat(path)
+            stamp.extend((st.st_mtime_ns, st.st_size))
+        except OSError:
+            stamp.extend((0, 0))
+    return stamp
+
+
+def get_workspace_threads(db_path: str) -> Optional[List[Tuple[str, Dict[str, Any]]]]:
+    """Get composer threads from one workspace database on its own connection.
+
+    Returns None for databases that can't be opened or read.
+    """
+    try:
+        conn = connect_db_readonly(db_path)
+        try:
+            return get_composer_threads(conn)
+        finally:
+            conn.close()
+    except Exception:
+        return None  # Skip databases that can't be opened
+
+
+def get_all_composer_threads(verbose: bool = False, workspace_cache: Dict[str, Any] = None) -> List[Tuple[str, Dict[str, Any]]]:
+    """Get all composer threads from global and workspace databases.
+
+    workspace_cache maps workspace DB path -> {'stamp': ..., 'threads': ...}
+    from a previous run. Databases whose get_db_stamp() is unchanged reuse
+    their cached threads instead of being opened; the cache is updated in place.
+    """
     all_threads = {}  # Use dict to deduplicate by cid
     
     # Get from global database
@@ -132,17 +292,41 @@ def get_all_composer_threads(verbose: bool = False) -> List[Tuple[str, Dict[str,
     if verbose:
         print(f"Searching {len(workspace_dbs)} workspace databases...")
     
+    if workspace_cache is None:
+        workspace_cache = {}
+    stamps = {db_path: get_db_stamp(db_path) for db_path in workspace_dbs}
+    threads_by_db = {}
+    changed_dbs = []
     for db_path in workspace_dbs:
-        try:
-            conn = connect_db_readonly(db_path)
-            threads = get_composer_threads(conn)
-            for cid, data in threads:
-                # Keep the most recently updated version
-                if cid not in all_threads or data.get('lastUpdatedAt', 0) > all_threads[cid].get('lastUpdatedAt', 0):
-                    all_threads[cid] = data
-            conn.close()
-        except Exception:
-            pass  # Skip databases that can't be opened
+        cached = workspace_cache.get(db_path)
+        if isinstance(cached, dict) and cached.get('stamp') == stamps[db_path]:
+            threads_by_db[db_path] = cached.get('threads') or []
+        else:
+            changed_dbs.append(db_path)
+    if verbose and len(changed_dbs) < len(workspace_dbs):
+        print(f"  {len(workspace_dbs) - len(changed_dbs)} unchanged since last export")
+
+    # Scans are I/O-bound and sqlite3 releases the GIL, so read DBs concurrently
+    if changed_dbs:
+        with ThreadPoolExecutor(max_workers=min(8, len(changed_dbs))) as executor:
+            for db_path, threads in zip(changed_dbs, executor.map(get_workspace_threads, changed_dbs)):
+                if threads is None:
+                    workspace_cache.pop(db_path, None)
+                    continue
+                threads_by_db[db_path] = threads
+                # Stamp taken before reading, so a write during the read is seen next run
+                workspace_cache[db_path] = {'stamp': stamps[db_path], 'threads': threads}
+
+    for db_path in list(workspace_cache):
+        if db_path not in stamps:
+            del workspace_cache[db_path]  # Workspace was removed
+
+    # Merge in path order, keeping the result independent of cache hits
+    for db_path in workspace_dbs:
+        for cid, data in threads_by_db.get(db_path, ()):
+            # Keep the most recently updated version
+            if cid not in all_threads or data.get('lastUpdatedAt', 0) > all_threads[cid].get('lastUpdatedAt', 0):
+                all_threads[cid] = data
     
     if verbose:
         print(f"Total unique threads found: {len(all_threads)}")
@@ -152,29 +336,6 @@ def get_all_composer_threads(verbose: bool = False) -> List[Tuple[str, Dict[str,
     return sorted_threads
 
 
-def get_thread_bubbles(conn: sqlite3.Connection, cid: str) -> List[Dict[str, Any]]:
-    """Get all conversation bubbles (messages) for a thread."""
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT key, value
-        FROM cursorDiskKV
-        WHERE key LIKE ?
-        ORDER BY COALESCE(json_extract(value,'$.createdAt'),0) ASC
-    """, (f"bubbleId:{cid}:%",))
-
-    bubbles = []
-    for _, value_blob in cursor.fetchall():
-        try:
-            if value_blob is None:
-                continue
-            bubble = json.loads(value_blob)
-            bubbles.append(bubble)
-        except (json.JSONDecodeError, TypeError):
-            continue
-
-    return bubbles
-
-
 def get_bubbles_batch(conn: sqlite3.Connection, cid_set: set) -> Dict[str, List[Dict[str, Any]]]:
     """Fetch bubbles for multiple CIDs in a single table scan.
 
@@ -185,25 +346,28 @@ def get_bubbles_batch(conn: sqlite3.Connection, cid_set: set) -> Dict[str, List[
     cursor.execute("""
         SELECT key, value
         FROM cursorDiskKV
-        WHERE key LIKE 'bubbleId:%'
-        ORDER BY COALESCE(json_extract(value, '$.createdAt'), 0) ASC
-    """)
+        WHERE key >= ? AND key < ?
+    """, key_prefix_range('bubbleId:'))
 
-    result: Dict[str, List[Dict[str, Any]]] = {}
+    # Pre-seeded lists double as the cid_set membership test in the loop
+    result: Dict[str, List[Dict[str, Any]]] = {cid: [] for cid in cid_set}
     for key, value_blob in cursor:
         # key format: bubbleId:{cid}:{bubble_id}
-        rest = key[9:]  # strip 'bubbleId:'
-        colon = rest.find(':')
-        if colon == -1:
+        parts = key.split(':', 2)
+        if len(parts) < 3:
             continue
-        cid = rest[:colon]
-        if cid not in cid_set or value_blob is None:
+        bubbles = result.get(parts[1])
+        if bubbles is None or value_blob is None:
             continue
         try:
-            bubble = json.loads(value_blob)
+            bubble = json_loads(value_blob)
         except (json.JSONDecodeError, TypeError):
             continue
-        result.setdefault(cid, []).append(bubble)
+        bubbles.append(bubble)
+
+    # Order each thread by createdAt; see bubble_sort_key
+    for bubbles in result.values():
+        bubbles.sort(key=bubble_sort_key)
 
     return result
 
@@ -226,27 +390,57 @@ def extract_message_content(bubble: Dict[str, Any]) -> str:
 
 def extract_thinking_content(bubble: Dict[str, Any]) -> str:
     """Extract thinking content from a bubble if present."""
-    thinking = bubble.get('thinking', {})
+    thinking = bubble.get('thinking') or EMPTY_DICT
     if isinstance(thinking, dict):
         return thinking.get('text', '').strip()
     return ""
 
 
-def get_message_context(conn: sqlite3.Connection, cid: str, bubble_id: str) -> Dict[str, Any]:
-    """Get message context data for a specific bubble ID."""
+def scan_disk_kv(conn: sqlite3.Connection, cid_set: set) -> Tuple[Dict[str, List[Dict[str, Any]]], Dict[str, Dict[str, Dict[str, Any]]]]:
+    """Fetch bubbles and message contexts for multiple CIDs, one statement per thread.
+
+    Each statement covers both of a thread's key ranges (SQLite serves the OR
+    as two index seeks), so only that thread's rows are read: a run where a
+    few threads changed no longer walks every bubble in the database. Returns
+    (bubbles_by_cid, contexts_by_cid) where contexts_by_cid maps each CID to
+    {bubble_id: context}.
+    """
+    bubbles_by_cid: Dict[str, List[Dict[str, Any]]] = {}
+    contexts_by_cid: Dict[str, Dict[str, Dict[str, Any]]] = {}
     cursor = conn.cursor()
-    context_key = f"messageRequestContext:{cid}:{bubble_id}"
+    for cid in cid_set:
+        bubble_prefix = f"bubbleId:{cid}:"
+        context_prefix = f"messageRequestContext:{cid}:"
+        cursor.execute("""
+            SELECT key, value
+            FROM cursorDiskKV
+            WHERE (key >= ? AND key < ?) OR (key >= ? AND key < ?)
+        """, key_prefix_range(bubble_prefix) + key_prefix_range(context_prefix))
 
-    cursor.execute(
-        "SELECT value FROM cursorDiskKV WHERE key = ?", (context_key,))
-    result = cursor.fetchone()
+        bubbles: List[Dict[str, Any]] = []
+        contexts: Dict[str, Dict[str, Any]] = {}
+        for key, value_blob in cursor:
+            if not value_blob:
+                continue
+            is_bubble = key.startswith(bubble_prefix)
+            if not is_bubble and len(value_blob) < MIN_JSON_OBJECT_LEN:
+                continue
+            try:
+                data = json_loads(value_blob)
+            except (json.JSONDecodeError, TypeError):
+                continue
+            if is_bubble:
+                # Empty bubbles ('{}') still count towards **Messages:**
+                if isinstance(data, dict):
+                    bubbles.append(data)
+            else:
+                contexts[key[len(context_prefix):]] = data
 
-    if result and result[0]:
-        try:
-            return json.loads(result[0])
-        except json.JSONDecodeError:
-            return {}
-    return {}
+        bubbles.sort(key=bubble_sort_key)
+        bubbles_by_cid[cid] = bubbles
+        contexts_by_cid[cid] = contexts
+
+    return bubbles_by_cid, contexts_by_cid
 
 
 def truncate_string(s: str, max_len: int, suffix: str = '...') -> str:
@@ -264,14 +458,292 @@ def format_code_block(code: str, prefix: str = '', max_lines: int = None) -> Lis
     if not code.strip():
         return []
 
-    lines = code.split('\n')
-    result = []
-
     # For audit purposes, include everything (no truncation)
-    for line in lines:
-        result.append(f"{prefix}{line}")
+    return [prefix + line for line in code.split('\n')]
+
+
+def handle_codebase_search(args: Dict[str, Any], result_data: Any, actions: List[str]) -> None:
+    """Format a semantic codebase search and its file hits."""
+    arg = args.get
+    query = arg('query', '')
+    target_dirs = arg('target_directories', [])
+
+    actions.append(f"🔍 Searched: {query}")
+    if target_dirs:
+        dirs_str = ', '.join(str(d) for d in target_dirs)
+        actions.append(f"   → Scope: {dirs_str}")
+
+    # Add file results with line ranges - all results for audit completeness
+    code_results = result_data.get('codeResults', [])
+    if code_results:
+        actions.append(f"   → Found {len(code_results)} result(s)")
+        for code_result in code_results:
+            if isinstance(code_result, dict) and 'codeBlock' in code_result:
+                code_block = code_result['codeBlock']
+                file_path = code_block.get('relativeWorkspacePath', '')
+                start_line = code_block.get('startLine', '')
+                end_line = code_block.get('endLine', '')
+                if file_path:
+                    if start_line and end_line:
+                        actions.append(f"   📁 {file_path}:{start_line}-{end_line}")
+                    else:
+                        actions.append(f"   📁 {file_path}")
+
+
+def handle_read_file(args: Dict[str, Any], result_data: Any, actions: List[str]) -> None:
+    """Format a file read with its line range."""
+    arg = args.get
+    file_path = arg('target_file', '')
+    offset = arg('offset')
+    limit = arg('limit')
+
+    if file_path:
+        action_str = f"📖 Read file: {file_path}"
+        if offset is not None or limit is not None:
+            action_str += f" (lines {offset or 1}"
+            if limit:
+                action_str += f"-{(offset or 1) + limit - 1}"
+            action_str += ")"
+        actions.append(action_str)
+    else:
+        # Tool called but args missing (likely incomplete/cancelled)
+        actions.append(f"📖 Read file: (args unavailable)")
+
+
+def handle_write(args: Dict[str, Any], result_data: Any, actions: List[str]) -> None:
+    """Format a whole-file write including the written contents."""
+    arg = args.get
+    file_path = arg('file_path', '')
+    contents = arg('contents', '')
+    line_count = contents.count('\n') + 1 if contents else 0
+
+    if file_path:
+        actions.append(f"✏️ Write file: {file_path}")
+        if line_count > 0:
+            actions.append(f"   → {line_count} lines written")
+
+            # Include full file contents for audit completeness
+            actions.append("   Contents:")
+            actions.extend(format_code_block(contents, prefix='   | '))
+    else:
+        actions.append(f"✏️ Write file: (args unavailable)")
+
+
+def handle_search_replace(args: Dict[str, Any], result_data: Any, actions: List[str]) -> None:
+    """Format a search/replace edit with old and new text."""
+    arg = args.get
+    file_path = arg('file_path', '')
+    old_string = arg('old_string', '')
+    new_string = arg('new_string', '')
+    replace_all = arg('replace_all', False)
+
+    if file_path:
+        actions.append(f"🔧 Edit file: {file_path}")
+    else:
+        actions.append(f"🔧 Edit file: (args unavailable)")
+
+    # Include the actual diff context from the database
+    # This makes the content grep-able without losing information
+    if file_path and (old_string or new_string):
+        # Show what was removed
+        if old_string.strip():
+            actions.append("   Old:")
+            actions.extend(format_code_block(
+                old_string, prefix='   - ', max_lines=30))
+
+        # Show what was added
+        if new_string.strip():
+            actions.append("   New:")
+            actions.extend(format_code_block(
+                new_string, prefix='   + ', max_lines=30))
+
+        # Add summary
+        old_line_count = old_string.count('\n') + 1 if old_string else 0
+        new_line_count = new_string.count('\n') + 1 if new_string else 0
+        net_change = new_line_count - old_line_count
+
+        if net_change > 0:
+            actions.append(f"   → Net change: +{net_change} line(s)")
+        elif net_change < 0:
+            actions.append(f"   → Net change: {net_change} line(s)")
+
+    if replace_all:
+        actions.append("   → Replace all occurrences")
+
+
+def handle_run_terminal_cmd(args: Dict[str, Any], result_data: Any, actions: List[str]) -> None:
+    """Format a terminal command with its output and exit code."""
+    arg = args.get
+    command = arg('command', '')
+    is_background = arg('is_background', False)
+
+    if command:
+        action_str = f"💻 Run: `{command}`"
+        if is_background:
+            action_str += " (background)"
+        actions.append(action_str)
+    else:
+        # Tool called but args missing (likely incomplete/cancelled)
+        actions.append(f"💻 Run: (args unavailable)")
+
+    # Include full command output for grep-ability
+    result = result_data.get('output', '')
+    if result and isinstance(result, str):
+        result_stripped = result.strip()
+        if result_stripped:
+            actions.append("   Output:")
+            actions.extend(format_code_block(
+                result_stripped, prefix='   | ', max_lines=100))
+
+    # Also capture exit code if available
+    exit_code = result_data.get('exitCode')
+    if exit_code is not None and exit_code != 0:
+        actions.append(f"   → Exit code: {exit_code}")
+
+
+def handle_grep(args: Dict[str, Any], result_data: Any, actions: List[str]) -> None:
+    """Format a grep call with its options and result summary."""
+    arg = args.get
+    pattern = arg('pattern', '')
+    path = arg('path', '')
+    output_mode = arg('output_mode', 'content')
+    glob = arg('glob')
+    case_insensitive = arg('-i', False)
+
+    grep_opts = []
+    if case_insensitive:
+        grep_opts.append('-i')
+    if glob:
+        grep_opts.append(f'--glob {glob}')
+
+    opts_str = ' '.join(grep_opts)
+    if opts_str:
+        opts_str = f' ({opts_str})'
+
+    if path:
+        actions.append(f"🔎 Grep{opts_str}: '{pattern}' in {path}")
+    else:
+        actions.append(f"🔎 Grep{opts_str}: '{pattern}'")
+
+    # Show result summary
+    if output_mode == 'files_with_matches':
+        files = result_data.get('files', [])
+        if files:
+            actions.append(f"   → Found in {len(files)} file(s)")
+    elif output_mode == 'count':
+        actions.append("   → Output: match counts")
+
+
+def handle_list_dir(args: Dict[str, Any], result_data: Any, actions: List[str]) -> None:
+    """Format a directory listing."""
+    arg = args.get
+    dir_path = arg('target_directory', '')
+    ignore_globs = arg('ignore_globs', [])
+
+    actions.append(f"📂 Listed directory: {dir_path}")
+    if ignore_globs:
+        actions.append(f"   → Ignoring: {', '.join(ignore_globs)}")
+
+
+def handle_glob_file_search(args: Dict[str, Any], result_data: Any, actions: List[str]) -> None:
+    """Format a glob file search."""
+    arg = args.get
+    pattern = arg('glob_pattern', '')
+    target_dir = arg('target_directory', '')
+
+    actions.append(f"🔍 File search: {pattern}")
+    if target_dir:
+        actions.append(f"   → In: {target_dir}")
 
-    return result
+
+def handle_delete_file(args: Dict[str, Any], result_data: Any, actions: List[str]) -> None:
+    """Format a file deletion."""
+    file_path = args.get('target_file', '')
+    actions.append(f"🗑️ Delete file: {file_path}")
+
+
+def handle_edit_notebook(args: Dict[str, Any], result_data: Any, actions: List[str]) -> None:
+    """Format a notebook cell edit."""
+    arg = args.get
+    notebook = arg('target_notebook', '')
+    cell_idx = arg('cell_idx', '')
+    is_new = arg('is_new_cell', False)
+
+    action_str = f"📓 Edit notebook: {notebook}"
+    if is_new:
+        action_str += f" (new cell at {cell_idx})"
+    else:
+        action_str += f" (cell {cell_idx})"
+    actions.append(action_str)
+
+
+def handle_todo_write(args: Dict[str, Any], result_data: Any, actions: List[str]) -> None:
+    """Format a TODO list update with every item."""
+    arg = args.get
+    todos = arg('todos', [])
+    merge = arg('merge', False)
+
+    action_str = f"📝 TODO: {'Update' if merge else 'Create'} {len(todos)} item(s)"
+    actions.append(action_str)
+
+    # Show ALL todo items
+    for todo in todos:
+        if isinstance(todo, dict):
+            status = todo.get('status', 'unknown')
+            content = todo.get('content', '')
+            actions.append(f"   - [{status}] {content}")
+
+
+def handle_web_search(args: Dict[str, Any], result_data: Any, actions: List[str]) -> None:
+    """Format a web search with its returned references."""
+    search_term = args.get('search_term', '')
+    actions.append(f"🌐 Web search: {search_term}")
+
+    # Web search results are in the tool result, not bubble-level
+    if result_data and isinstance(result_data, dict):
+        references = result_data.get('references', [])
+        if references:
+            actions.append(f"   → {len(references)} result(s)")
+            for i, ref in enumerate(references, 1):
+                if isinstance(ref, dict):
+                    title = ref.get('title', 'Untitled')
+                    chunk = ref.get('chunk', '')
+                    actions.append(f"   {i}. {title}")
+                    if chunk:
+                        # Include the full chunk content for audit completeness
+                        actions.append(f"      {chunk}")
+        elif result_data.get('rejected'):
+            actions.append(f"   → Search was rejected/cancelled")
+
+
+def handle_generic_tool(tool_name: str, args: Dict[str, Any], actions: List[str]) -> None:
+    """Format any other named tool with its key arguments."""
+    actions.append(f"🔧 {tool_name}")
+    # Show ALL key arguments
+    if args:
+        key_args = []
+        for key in ['file_path', 'target_file', 'path', 'query', 'pattern']:
+            if key in args and args[key]:
+                key_args.append(f"{key}={str(args[key])}")
+        if key_args:
+            actions.append(f"   → {', '.join(key_args)}")
+
+
+# Tool name -> formatter, dispatched by extract_intermediate_actions()
+TOOL_ACTION_HANDLERS = {
+    'codebase_search': handle_codebase_search,
+    'read_file': handle_read_file,
+    'write': handle_write,
+    'search_replace': handle_search_replace,
+    'run_terminal_cmd': handle_run_terminal_cmd,
+    'grep': handle_grep,
+    'list_dir': handle_list_dir,
+    'glob_file_search': handle_glob_file_search,
+    'delete_file': handle_delete_file,
+    'edit_notebook': handle_edit_notebook,
+    'todo_write': handle_todo_write,
+    'web_search': handle_web_search,
+}
 
 
 def extract_intermediate_actions(bubble: Dict[str, Any]) -> List[str]:
@@ -279,278 +751,54 @@ def extract_intermediate_actions(bubble: Dict[str, Any]) -> List[str]:
     actions = []
 
     # Get tool former data which contains the agent's actions
-    tool_former_data = bubble.get('toolFormerData', {})
+    tool_former_data = bubble.get('toolFormerData') or EMPTY_DICT
 
     if isinstance(tool_former_data, dict):
-        tool_name = tool_former_data.get('name', '')
+        # Bind the hot .get lookups once; they run for every bubble
+        tool_get = tool_former_data.get
+        tool_name = tool_get('name', '')
 
         # Parse tool arguments - handle None, empty string, or JSON string
-        raw_args = tool_former_data.get('rawArgs')
+        raw_args = tool_get('rawArgs')
         args = {}
         if raw_args:
             try:
-                args = json.loads(raw_args) if isinstance(raw_args, str) else raw_args
+                args = json_loads(raw_args) if isinstance(raw_args, str) else raw_args
             except (json.JSONDecodeError, TypeError):
                 args = {}
         
         # Fallback: try to parse params field if rawArgs is missing
-        if not args and tool_former_data.get('params'):
+        if not args and tool_get('params'):
             try:
-                params_str = tool_former_data.get('params', '')
+                params_str = tool_get('params', '')
                 if isinstance(params_str, str):
-                    params_data = json.loads(params_str)
+                    params_data = json_loads(params_str)
                     # Extract args from params if available
                     if isinstance(params_data, dict):
                         args = params_data
             except (json.JSONDecodeError, TypeError):
                 pass
+        if not isinstance(args, dict):
+            args = {}
 
         # Parse tool results
         result_data = {}
-        raw_result = tool_former_data.get('result', '')
+        raw_result = tool_get('result', '')
         try:
-            result_data = json.loads(raw_result) if raw_result else {}
+            result_data = json_loads(raw_result) if raw_result else {}
         except json.JSONDecodeError:
             result_data = {}
 
         # Format action based on tool type with enhanced details
-        if tool_name == 'codebase_search':
-            query = args.get('query', '')
-            target_dirs = args.get('target_directories', [])
-
-            actions.append(f"🔍 Searched: {query}")
-            if target_dirs:
-                dirs_str = ', '.join(str(d) for d in target_dirs)
-                actions.append(f"   → Scope: {dirs_str}")
-
-            # Add file results with line ranges - all results for audit completeness
-            code_results = result_data.get('codeResults', [])
-            if code_results:
-                actions.append(f"   → Found {len(code_results)} result(s)")
-                for code_result in code_results:
-                    if isinstance(code_result, dict) and 'codeBlock' in code_result:
-                        code_block = code_result['codeBlock']
-                        file_path = code_block.get('relativeWorkspacePath', '')
-                        start_line = code_block.get('startLine', '')
-                        end_line = code_block.get('endLine', '')
-                        if file_path:
-                            if start_line and end_line:
-                                actions.append(f"   📁 {file_path}:{start_line}-{end_line}")
-                            else:
-                                actions.append(f"   📁 {file_path}")
-
-        elif tool_name == 'read_file':
-            file_path = args.get('target_file', '')
-            offset = args.get('offset')
-            limit = args.get('limit')
-
-            if file_path:
-                action_str = f"📖 Read file: {file_path}"
-                if offset is not None or limit is not None:
-                    action_str += f" (lines {offset or 1}"
-                    if limit:
-                        action_str += f"-{(offset or 1) + limit - 1}"
-                    action_str += ")"
-                actions.append(action_str)
-            else:
-                # Tool called but args missing (likely incomplete/cancelled)
-                actions.append(f"📖 Read file: (args unavailable)")
-
-        elif tool_name == 'write':
-            file_path = args.get('file_path', '')
-            contents = args.get('contents', '')
-            line_count = len(contents.split('\n')) if contents else 0
-
-            if file_path:
-                actions.append(f"✏️ Write file: {file_path}")
-                if line_count > 0:
-                    actions.append(f"   → {line_count} lines written")
-
-                    # Include full file contents for audit completeness
-                    actions.append("   Contents:")
-                    actions.extend(format_code_block(contents, prefix='   | '))
-            else:
-                actions.append(f"✏️ Write file: (args unavailable)")
-
-        elif tool_name == 'search_replace':
-            file_path = args.get('file_path', '')
-            old_string = args.get('old_string', '')
-            new_string = args.get('new_string', '')
-            replace_all = args.get('replace_all', False)
-
-            if file_path:
-                actions.append(f"🔧 Edit file: {file_path}")
-            else:
-                actions.append(f"🔧 Edit file: (args unavailable)")
-
-            # Include the actual diff context from the database
-            # This makes the content grep-able without losing information
-            if file_path and (old_string or new_string):
-                # Show what was removed
-                if old_string.strip():
-                    actions.append("   Old:")
-                    actions.extend(format_code_block(
-                        old_string, prefix='   - ', max_lines=30))
-
-                # Show what was added
-                if new_string.strip():
-                    actions.append("   New:")
-                    actions.extend(format_code_block(
-                        new_string, prefix='   + ', max_lines=30))
-
-                # Add summary
-                old_line_count = len(old_string.split('\n')
-                                     ) if old_string else 0
-                new_line_count = len(new_string.split('\n')
-                                     ) if new_string else 0
-                net_change = new_line_count - old_line_count
-
-                if net_change > 0:
-                    actions.append(f"   → Net change: +{net_change} line(s)")
-                elif net_change < 0:
-                    actions.append(f"   → Net change: {net_change} line(s)")
-
-            if replace_all:
-                actions.append("   → Replace all occurrences")
-
-        elif tool_name == 'run_terminal_cmd':
-            command = args.get('command', '')
-            is_background = args.get('is_background', False)
-
-            if command:
-                action_str = f"💻 Run: `{command}`"
-                if is_background:
-                    action_str += " (background)"
-                actions.append(action_str)
-            else:
-                # Tool called but args missing (likely incomplete/cancelled)
-                actions.append(f"💻 Run: (args unavailable)")
-
-            # Include full command output for grep-ability
-            result = result_data.get('output', '')
-            if result and isinstance(result, str):
-                result_stripped = result.strip()
-                if result_stripped:
-                    actions.append("   Output:")
-                    actions.extend(format_code_block(
-                        result_stripped, prefix='   | ', max_lines=100))
-
-            # Also capture exit code if available
-            exit_code = result_data.get('exitCode')
-            if exit_code is not None and exit_code != 0:
-                actions.append(f"   → Exit code: {exit_code}")
-
-        elif tool_name == 'grep':
-            pattern = args.get('pattern', '')
-            path = args.get('path', '')
-            output_mode = args.get('output_mode', 'content')
-            glob = args.get('glob')
-            case_insensitive = args.get('-i', False)
-
-            grep_opts = []
-            if case_insensitive:
-                grep_opts.append('-i')
-            if glob:
-                grep_opts.append(f'--glob {glob}')
-
-            opts_str = ' '.join(grep_opts)
-            if opts_str:
-                opts_str = f' ({opts_str})'
-
-            if path:
-                actions.append(f"🔎 Grep{opts_str}: '{pattern}' in {path}")
-            else:
-                actions.append(f"🔎 Grep{opts_str}: '{pattern}'")
-
-            # Show result summary
-            if output_mode == 'files_with_matches':
-                files = result_data.get('files', [])
-                if files:
-                    actions.append(f"   → Found in {len(files)} file(s)")
-            elif output_mode == 'count':
-                actions.append("   → Output: match counts")
-
-        elif tool_name == 'list_dir':
-            dir_path = args.get('target_directory', '')
-            ignore_globs = args.get('ignore_globs', [])
-
-            actions.append(f"📂 Listed directory: {dir_path}")
-            if ignore_globs:
-                actions.append(f"   → Ignoring: {', '.join(ignore_globs)}")
-
-        elif tool_name == 'glob_file_search':
-            pattern = args.get('glob_pattern', '')
-            target_dir = args.get('target_directory', '')
-
-            actions.append(f"🔍 File search: {pattern}")
-            if target_dir:
-                actions.append(f"   → In: {target_dir}")
-
-        elif tool_name == 'delete_file':
-            file_path = args.get('target_file', '')
-            actions.append(f"🗑️ Delete file: {file_path}")
-
-        elif tool_name == 'edit_notebook':
-            notebook = args.get('target_notebook', '')
-            cell_idx = args.get('cell_idx', '')
-            is_new = args.get('is_new_cell', False)
-
-            action_str = f"📓 Edit notebook: {notebook}"
-            if is_new:
-                action_str += f" (new cell at {cell_idx})"
-            else:
-                action_str += f" (cell {cell_idx})"
-            actions.append(action_str)
-
-        elif tool_name == 'todo_write':
-            todos = args.get('todos', [])
-            merge = args.get('merge', False)
-
-            action_str = f"📝 TODO: {'Update' if merge else 'Create'} {len(todos)} item(s)"
-            actions.append(action_str)
-
-            # Show ALL todo items
-            for todo in todos:
-                if isinstance(todo, dict):
-                    status = todo.get('status', 'unknown')
-                    content = todo.get('content', '')
-                    actions.append(f"   - [{status}] {content}")
-
-        elif tool_name == 'web_search':
-            search_term = args.get('search_term', '')
-            actions.append(f"🌐 Web search: {search_term}")
-
-            # Web search results are in the tool result, not bubble-level
-            if result_data and isinstance(result_data, dict):
-                references = result_data.get('references', [])
-                if references:
-                    actions.append(f"   → {len(references)} result(s)")
-                    for i, ref in enumerate(references, 1):
-                        if isinstance(ref, dict):
-                            title = ref.get('title', 'Untitled')
-                            chunk = ref.get('chunk', '')
-                            actions.append(f"   {i}. {title}")
-                            if chunk:
-                                # Include the full chunk content for audit completeness
-                                actions.append(f"      {chunk}")
-                elif result_data.get('rejected'):
-                    actions.append(f"   → Search was rejected/cancelled")
-
-        elif tool_name and tool_name != '':
-            # Generic tool with name
-            actions.append(f"🔧 {tool_name}")
-            # Show ALL key arguments
-            if args:
-                key_args = []
-                for key in ['file_path', 'target_file', 'path', 'query', 'pattern']:
-                    if key in args and args[key]:
-                        key_args.append(f"{key}={str(args[key])}")
-                if key_args:
-                    actions.append(f"   → {', '.join(key_args)}")
+        handler = TOOL_ACTION_HANDLERS.get(tool_name)
+        if handler:
+            handler(args, result_data, actions)
+        elif tool_name:
+            handle_generic_tool(tool_name, args, actions)
 
     # Check for bubble-level web search results (legacy/alternative storage)
     # Note: Most web search results are now in the tool's result field (handled above)
-    web_search = bubble.get('aiWebSearchResults', [])
+    web_search = bubble.get('aiWebSearchResults') or ()
     if web_search:
         actions.append(f"🌐 Additional web search results: {len(web_search)} result(s)")
         for i, result in enumerate(web_search, 1):
@@ -569,7 +817,7 @@ def extract_intermediate_actions(bubble: Dict[str, Any]) -> List[str]:
                         actions.append(f"      Content: {chunk}")
 
     # Check for docs references - include ALL
-    docs_refs = bubble.get('docsReferences', [])
+    docs_refs = bubble.get('docsReferences') or ()
     if docs_refs:
         actions.append(f"📚 Docs: {len(docs_refs)} reference(s)")
         for ref in docs_refs:
@@ -582,14 +830,14 @@ def extract_intermediate_actions(bubble: Dict[str, Any]) -> List[str]:
                     actions.append(f"     {url}")
 
     # Check for web references - include ALL
-    web_refs = bubble.get('webReferences', [])
+    web_refs = bubble.get('webReferences') or ()
     if web_refs:
         for ref in web_refs:
             if isinstance(ref, dict) and ref.get('url'):
                 actions.append(f"🔗 {ref['url']}")
 
     # Check for context pieces
-    context_pieces = bubble.get('contextPieces', [])
+    context_pieces = bubble.get('contextPieces') or ()
     if context_pieces:
         actions.append(f"📋 Context: {len(context_pieces)} piece(s)")
 
@@ -619,30 +867,24 @@ def get_message_role(bubble: Dict[str, Any]) -> str:
     return 'unknown'
 
 
+@lru_cache(maxsize=4096)
+def format_timestamp(timestamp_ms: int, fmt: str) -> str:
+    """Format a millisecond timestamp as local time, memoized per (timestamp, format)."""
+    return datetime.fromtimestamp(timestamp_ms / 1000).strftime(fmt)
+
+
 def format_timestamp_filename(timestamp_ms: int) -> str:
     """Format timestamp for filename: YYYY-MM-DDTHHMM."""
-    dt = datetime.fromtimestamp(timestamp_ms / 1000)
-    return dt.strftime('%Y-%m-%dT%H%M')
+    return format_timestamp(timestamp_ms, '%Y-%m-%dT%H%M')
 
 
 def slugify_title(title: str, max_length: int = 50) -> str:
     """Convert title to URL-safe slug."""
-    import re
-
-    # Take first line only and limit length
-    title = title.split('\n')[0][:max_length]
-
-    # Replace problematic characters
-    replacements = {
-        '/': '-', '\\': '-', ':': '-', '*': '-', '?': '-',
-        '"': '', '<': '-', '>': '-', '|': '-', ' ': '-'
-    }
-
-    for old, new in replacements.items():
-        title = title.replace(old, new)
+    # Take first line only, limit length, and replace problematic characters
+    title = title.split('\n', 1)[0][:max_length].translate(SLUG_TRANSLATION)
 
     # Clean up multiple dashes and trim
-    title = re.sub(r'-+', '-', title).strip('-')
+    title = SLUG_DASHES_RE.sub('-', title).strip('-')
 
     return title or 'untitled'
 
@@ -663,37 +905,41 @@ def generate_filename(thread_data: Dict[str, Any], cid: str, first_message: str)
     return f"{timestamp_str}-{title_slug}-{cid_short}.md"
 
 
-def format_conversation_markdown(thread_data: Dict[str, Any], cid: str, bubbles: List[Dict[str, Any]], filename: str, conn: sqlite3.Connection) -> str:
-    """Format conversation as markdown."""
+def format_conversation_markdown(thread_data: Dict[str, Any], cid: str, bubbles: List[Dict[str, Any]], contexts: Dict[str, Dict[str, Any]]) -> Tuple[str, str]:
+    """Format conversation as markdown.
+
+    contexts maps bubble_id to message context for this thread (one entry of
+    scan_disk_kv()'s contexts_by_cid).
+
+    Returns (markdown, first_content), where first_content is the first
+    non-empty message (for generate_filename()), or "" if there is none.
+    """
     # Extract metadata
     thread_name = thread_data.get('name', 'Untitled Conversation')
     created_at = thread_data.get('createdAt', 0)
     updated_at = thread_data.get('lastUpdatedAt', created_at)
 
-    created_str = datetime.fromtimestamp(
-        created_at / 1000).strftime('%Y-%m-%d %H:%M:%S')
-    updated_str = datetime.fromtimestamp(
-        updated_at / 1000).strftime('%Y-%m-%d %H:%M:%S')
+    created_str = format_timestamp(created_at, '%Y-%m-%d %H:%M:%S')
+    updated_str = format_timestamp(updated_at, '%Y-%m-%d %H:%M:%S')
 
     # Calculate total tokens if available
     total_input_tokens = 0
     total_output_tokens = 0
     for bubble in bubbles:
-        token_count = bubble.get('tokenCount', {})
+        token_count = bubble.get('tokenCount') or EMPTY_DICT
         if isinstance(token_count, dict):
             total_input_tokens += token_count.get('inputTokens', 0)
             total_output_tokens += token_count.get('outputTokens', 0)
 
-    # Build markdown
-    md_lines = [
-        f"# {thread_name}",
-        "",
-        f"**Exported:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}  ",
-        f"**Thread ID:** `{cid}`  ",
-        f"**Created:** {created_str}  ",
-        f"**Last Updated:** {updated_str}  ",
-        f"**Messages:** {len(bubbles)}  ",
-    ]
+    # Build markdown as a list of lines joined once at the end (faster than io.StringIO)
+    md_lines = [CONVERSATION_HEADER_TEMPLATE.format(
+        thread_name=thread_name,
+        exported=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        cid=cid,
+        created=created_str,
+        updated=updated_str,
+        message_count=len(bubbles),
+    )]
 
     # Add token usage if available
     if total_input_tokens > 0 or total_output_tokens > 0:
@@ -715,31 +961,56 @@ def format_conversation_markdown(thread_data: Dict[str, Any], cid: str, bubbles:
                 ""
             ])
 
+    # Extract every bubble once up front; the action-grouping lookahead below
+    # reads these instead of re-extracting each bubble it inspects
+    contents = [extract_message_content(bubble) for bubble in bubbles]
+    has_content = [bool(content.strip()) for content in contents]
+    thinkings = [extract_thinking_content(bubble) for bubble in bubbles]
+    bubble_actions = [extract_intermediate_actions(bubble) for bubble in bubbles]
+    # Most threads carry no request context; skip the lookups when empty
+    bubble_contexts = [(contexts.get(bubble_id) or EMPTY_DICT) if contexts and bubble_id else EMPTY_DICT
+                       for bubble_id in (bubble.get('bubbleId', '') for bubble in bubbles)]
+    # Bubbles the lookahead folds into a preceding action-only group: no
+    # content, thinking, or request context, but some actions
+    groupable = [
+        not has_content[k] and bool(bubble_actions[k]) and not thinkings[k] and
+        not any(bubble_contexts[k].get(field) for field in ('files', 'todos', 'terminalFiles', 'cursorRules'))
+        for k in range(len(bubbles))
+    ]
+
     # Process messages - group consecutive agent content together
     i = 0
     last_role = None
 
     while i < len(bubbles):
         bubble = bubbles[i]
-        content = extract_message_content(bubble)
+        content = contents[i]
+        content_present = has_content[i]
         role = get_message_role(bubble)
-        bubble_id = bubble.get('bubbleId', '')
-
-        # Get message context data
-        context_data = get_message_context(
-            conn, cid, bubble_id) if bubble_id else {}
-
-        # Check for thinking content
-        thinking_content = extract_thinking_content(bubble)
-
-        # Check for intermediate actions (agent context)
-        actions = extract_intermediate_actions(bubble)
+        # Read the bubble-level fields once up front. `or ()` falls back to a
+        # constant, unlike a [] default which allocated a list per missing field.
+        bubble_get = bubble.get
+        git_diffs = bubble_get('gitDiffs') or ()
+        commits = bubble_get('commits') or ()
+        pull_requests = bubble_get('pullRequests') or ()
+        lints = bubble_get('lints') or ()
+        approx_lints = bubble_get('approximateLintErrors') or ()
+        multi_lints = bubble_get('multiFileLinterErrors') or ()
+        human_changes = bubble_get('humanChanges') or ()
+        attached_folders = bubble_get('attachedFolders') or bubble_get('attachedFoldersNew') or ()
+        recently_viewed = bubble_get('recentlyViewedFiles') or ()
+        images = bubble_get('images') or ()
+        is_agentic = bubble_get('isAgentic')
+
+        context_data = bubble_contexts[i]
+        thinking_content = thinkings[i]
+        actions = bubble_actions[i]
 
         # Check for context information
         context_info = []
         if context_data:
             # Files used - include ALL for audit completeness
-            files = context_data.get('files', [])
+            files = context_data.get('files') or ()
             if files:
                 context_info.append(f"**Files Referenced ({len(files)}):**")
                 for file_info in files:
@@ -748,7 +1019,7 @@ def format_conversation_markdown(thread_data: Dict[str, Any], cid: str, bubbles:
                 context_info.append("")
 
             # TODOs - include ALL
-            todos = context_data.get('todos', [])
+            todos = context_data.get('todos') or ()
             if todos:
                 context_info.append(f"**[TODOs]** ({len(todos)})")
                 for todo in todos:
@@ -760,7 +1031,7 @@ def format_conversation_markdown(thread_data: Dict[str, Any], cid: str, bubbles:
                     elif isinstance(todo, str):
                         # If it's a string, try to parse as JSON
                         try:
-                            todo_obj = json.loads(todo)
+                            todo_obj = json_loads(todo)
                             if isinstance(todo_obj, dict):
                                 todo_content = todo_obj.get(
                                     'content', 'Unknown')
@@ -778,7 +1049,7 @@ def format_conversation_markdown(thread_data: Dict[str, Any], cid: str, bubbles:
             # Knowledge items (cursor rules) - skip these
 
             # Terminal files - include ALL
-            terminal_files = context_data.get('terminalFiles', [])
+            terminal_files = context_data.get('terminalFiles') or ()
             if terminal_files:
                 context_info.append(
                     f"**Terminal Context ({len(terminal_files)}):**")
@@ -787,7 +1058,7 @@ def format_conversation_markdown(thread_data: Dict[str, Any], cid: str, bubbles:
                 context_info.append("")
 
             # Cursor rules - show ALL with complete content
-            cursor_rules = context_data.get('cursorRules', [])
+            cursor_rules = context_data.get('cursorRules') or ()
             if cursor_rules:
                 context_info.append(f"**Cursor Rules ({len(cursor_rules)}):**")
                 for rule in cursor_rules:
@@ -801,7 +1072,6 @@ def format_conversation_markdown(thread_data: Dict[str, Any], cid: str, bubbles:
                 context_info.append("")
 
         # Add git-related information from bubble - ALL diffs with COMPLETE content
-        git_diffs = bubble.get('gitDiffs', [])
         if git_diffs:
             context_info.append(f"**Git Diffs ({len(git_diffs)}):**")
             for diff in git_diffs:
@@ -812,13 +1082,11 @@ def format_conversation_markdown(thread_data: Dict[str, Any], cid: str, bubbles:
                     if diff_content:
                         # Include the COMPLETE diff for audit purposes
                         context_info.append("  ```diff")
-                        diff_lines = diff_content.split('\n')
-                        for line in diff_lines:
-                            context_info.append(f"  {line}")
+                        # Indent every line in one pass rather than per-line appends
+                        context_info.append("  " + diff_content.replace('\n', '\n  '))
                         context_info.append("  ```")
             context_info.append("")
 
-        commits = bubble.get('commits', [])
         if commits:
             context_info.append(f"**Git Commits ({len(commits)}):**")
             for commit in commits:
@@ -828,7 +1096,6 @@ def format_conversation_markdown(thread_data: Dict[str, Any], cid: str, bubbles:
                     context_info.append(f"- {sha}: {message}")
             context_info.append("")
 
-        pull_requests = bubble.get('pullRequests', [])
         if pull_requests:
             context_info.append(f"**Pull Requests ({len(pull_requests)}):**")
             for pr in pull_requests:
@@ -839,14 +1106,10 @@ def format_conversation_markdown(thread_data: Dict[str, Any], cid: str, bubbles:
             context_info.append("")
 
         # Add linting errors - ALL errors with complete messages
-        lints = bubble.get('lints', [])
-        approx_lints = bubble.get('approximateLintErrors', [])
-        multi_lints = bubble.get('multiFileLinterErrors', [])
-
-        all_lints = lints + approx_lints + multi_lints
-        if all_lints:
-            context_info.append(f"**Linting Issues ({len(all_lints)}):**")
-            for lint in all_lints:
+        lint_count = len(lints) + len(approx_lints) + len(multi_lints)
+        if lint_count:
+            context_info.append(f"**Linting Issues ({lint_count}):**")
+            for lint in itertools.chain(lints, approx_lints, multi_lints):
                 if isinstance(lint, dict):
                     severity = lint.get('severity', 'error')
                     message = lint.get('message', 'Unknown')
@@ -863,7 +1126,6 @@ def format_conversation_markdown(thread_data: Dict[str, Any], cid: str, bubbles:
             context_info.append("")
 
         # Add human edits to AI suggestions - ALL changes
-        human_changes = bubble.get('humanChanges', [])
         if human_changes:
             context_info.append(f"**Human Edits ({len(human_changes)}):**")
             for change in human_changes:
@@ -874,8 +1136,6 @@ def format_conversation_markdown(thread_data: Dict[str, Any], cid: str, bubbles:
             context_info.append("")
 
         # Add attached folders context - ALL folders
-        attached_folders = bubble.get(
-            'attachedFolders', []) or bubble.get('attachedFoldersNew', [])
         if attached_folders:
             context_info.append(
                 f"**Attached Folders ({len(attached_folders)}):**")
@@ -889,8 +1149,7 @@ def format_conversation_markdown(thread_data: Dict[str, Any], cid: str, bubbles:
             context_info.append("")
 
         # Add recently viewed files - ALL files
-        recently_viewed = bubble.get('recentlyViewedFiles', [])
-        if recently_viewed and len(recently_viewed) > 0:
+        if recently_viewed:
             context_info.append(
                 f"**Recently Viewed Files ({len(recently_viewed)}):**")
             for file in recently_viewed:
@@ -903,7 +1162,6 @@ def format_conversation_markdown(thread_data: Dict[str, Any], cid: str, bubbles:
             context_info.append("")
 
         # Add images - ALL images
-        images = bubble.get('images', [])
         if images:
             context_info.append(f"**Images ({len(images)}):**")
             for img in images:
@@ -916,49 +1174,29 @@ def format_conversation_markdown(thread_data: Dict[str, Any], cid: str, bubbles:
             context_info.append("")
 
         # Add capabilities/mode if interesting
-        is_agentic = bubble.get('isAgentic')
         if is_agentic:
             context_info.append("**Mode:** Agentic")
             context_info.append("")
 
         # Skip empty bubbles unless they have actions, context, or thinking
-        if not content.strip() and not actions and not context_info and not thinking_content:
+        if not content_present and not actions and not context_info and not thinking_content:
             i += 1
             continue
 
         # Add separator only when transitioning between user and agent
         if last_role is not None and last_role != role:
-            md_lines.extend(["", "---", ""])
+            md_lines.extend(ROLE_SEPARATOR_LINES)
 
         # Check if this is an action-only bubble and look ahead for consecutive action bubbles
-        if not content.strip() and actions and not context_info and not thinking_content:
+        if not content_present and actions and not context_info and not thinking_content:
             # This is an action-only bubble - collect all consecutive action bubbles
-            all_actions = []
-            all_actions.extend(actions)
+            all_actions = list(actions)
 
             # Look ahead for more action-only bubbles
             j = i + 1
-            while j < len(bubbles):
-                next_bubble = bubbles[j]
-                next_content = extract_message_content(next_bubble)
-                next_bubble_id = next_bubble.get('bubbleId', '')
-                next_context_data = get_message_context(
-                    conn, cid, next_bubble_id) if next_bubble_id else {}
-                next_actions = extract_intermediate_actions(next_bubble)
-                next_thinking = extract_thinking_content(next_bubble)
-
-                # Check if next bubble is also action-only (no content, no context, no thinking, but has actions)
-                next_context_info = []
-                if next_context_data:
-                    for field in ['files', 'todos', 'terminalFiles', 'cursorRules']:
-                        if next_context_data.get(field):
-                            next_context_info.append(field)
-
-                if not next_content.strip() and next_actions and not next_context_info and not next_thinking:
-                    all_actions.extend(next_actions)
-                    j += 1
-                else:
-                    break
+            while j < len(bubbles) and groupable[j]:
+                all_actions.extend(bubble_actions[j])
+                j += 1
 
             # Output grouped actions
             md_lines.append("**[Actions]**")
@@ -977,22 +1215,17 @@ def format_conversation_markdown(thread_data: Dict[str, Any], cid: str, bubbles:
             md_lines.append("")
 
         # Format content if available
-        if content.strip():
-            if role == 'user':
-                md_lines.append(f"**[User]** {content}")
-            elif role == 'assistant':
-                md_lines.append(f"**[Agent]** {content}")
-            else:
-                md_lines.append(f"**[{role.title()}]** {content}")
+        if content_present:
+            md_lines.append((ROLE_PREFIX.get(role) or f"**[{role.title()}]** ") + content)
 
         # Add context information if present
         if context_info:
-            if content.strip():
+            if content_present:
                 md_lines.append("")  # Add space between content and context
             md_lines.extend(context_info)
 
         # Add intermediate actions if present (for bubbles with content)
-        if actions and content.strip():
+        if actions and content_present:
             md_lines.append("")  # Add space before actions
             md_lines.append("**[Actions]**")
             for action in actions:
@@ -1004,7 +1237,64 @@ def format_conversation_markdown(thread_data: Dict[str, Any], cid: str, bubbles:
         last_role = role
         i += 1
 
-    return '\n'.join(md_lines)
+    first_content = next((content for content, present in zip(contents, has_content) if present), "")
+    return '\n'.join(md_lines), first_content
+
+
+def available_cpu_count() -> int:
+    """Return the number of CPUs this process may run on.
+
+    Honours CPU affinity (taskset, container cpusets) where the platform
+    exposes it; os.cpu_count() reports every CPU in the machine.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def write_conversation_markdown(output_path: Path, thread_data: Dict[str, Any], cid: str, bubbles: List[Dict[str, Any]], contexts: Dict[str, Dict[str, Any]]) -> str:
+    """Format one conversation and write it into output_path.
+
+    Returns the filename written, or "" if the thread has no content and
+    nothing was written. Module-level so ProcessPoolExecutor workers can run it.
+    """
+    markdown_content, first_content = format_conversation_markdown(thread_data, cid, bubbles, contexts)
+    if not first_content:
+        return ""
+
+    filename = generate_filename(thread_data, cid, first_content)
+    with open(output_path / filename, 'w', encoding='utf-8') as f:
+        f.write(markdown_content)
+    return filename
+
+
+def load_export_manifest(output_path: Path) -> Dict[str, Any]:
+    """Load the manifest written by the previous export.
+
+    'threads' maps cid -> lastUpdatedAt as exported; 'workspaces' is the
+    workspace_cache for get_all_composer_threads(). Missing or unreadable
+    manifests load as empty.
+    """
+    try:
+        with open(output_path / EXPORT_MANIFEST_NAME, 'rb') as f:
+            manifest = json_loads(f.read())
+    except (OSError, json.JSONDecodeError):
+        manifest = None
+    if not isinstance(manifest, dict):
+        manifest = {}
+    for section in ('threads', 'workspaces'):
+        if not isinstance(manifest.get(section), dict):
+            manifest[section] = {}
+    return manifest
+
+
+def save_export_manifest(output_path: Path, manifest: Dict[str, Any]) -> None:
+    """Write the export manifest, replacing the old one atomically."""
+    manifest_file = output_path / EXPORT_MANIFEST_NAME
+    tmp_file = manifest_file.with_suffix('.tmp')
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_file, manifest_file)
 
 
 def export_conversations(output_dir: str, verbose: bool = False, min_timestamp_ms: int = None) -> None:
@@ -1024,8 +1314,12 @@ def export_conversations(output_dir: str, verbose: bool = False, min_timestamp_m
             min_dt = datetime.fromtimestamp(min_timestamp_ms / 1000)
             print(f"Filtering conversations created after: {min_dt}")
 
+    # State from the previous export into this directory
+    manifest = load_export_manifest(output_path)
+    exported_threads = manifest['threads']  # cid -> lastUpdatedAt as exported
+
     # Get all threads from global and workspace databases
-    threads = get_all_composer_threads(verbose)
+    threads = get_all_composer_threads(verbose, manifest['workspaces'])
     
     # Filter by timestamp if provided
     if min_timestamp_ms:
@@ -1041,7 +1335,7 @@ def export_conversations(output_dir: str, verbose: bool = False, min_timestamp_m
         print(f"Error: Cursor global database not found at {global_db}")
         return
     
-    conn = connect_db_readonly(global_db)
+    conn = connect_db_readonly(global_db, mmap_size=GLOBAL_DB_MMAP_SIZE)
 
     try:
 
@@ -1050,26 +1344,36 @@ def export_conversations(output_dir: str, verbose: bool = False, min_timestamp_m
 
         # Pre-index existing files by cid short-hash (last 8 chars of stem before .md)
         # Filename format: {timestamp}-{slug}-{cid[:8]}.md
-        existing_by_cid: Dict[str, Path] = {}
-        for f in output_path.glob('*.md'):
-            existing_by_cid[f.stem[-8:]] = f
+        # scandir's DirEntry avoids building a Path per file and caches stat()
+        with os.scandir(output_path) as entries:
+            existing_by_cid: Dict[str, os.DirEntry] = {
+                entry.name[-11:-3]: entry for entry in entries
+                if entry.name.endswith('.md') and len(entry.name) > 11
+            }
 
         exported_count = 0
 
         # Partition threads into up-to-date (skip) vs. needs-export, then
-        # batch-fetch all bubble data for the latter in a single table scan.
+        # fetch bubble data for the latter with one range seek per thread.
         needs_export = []
         for cid, thread_data in threads:
-            cid_short = cid[:8]
+            existing = existing_by_cid.get(cid[:8])
             thread_updated_ms = thread_data.get('lastUpdatedAt', thread_data.get('createdAt', 0))
-            if thread_updated_ms and cid_short in existing_by_cid:
-                if existing_by_cid[cid_short].stat().st_mtime * 1000 >= thread_updated_ms:
+            if thread_updated_ms and existing is not None:
+                # Unchanged since the last export, or the file is newer than the thread.
+                # stat() only runs when the manifest misses: on POSIX readdir
+                # returns no mtimes, so stat'ing every entry up front would
+                # cost a syscall per file even when the manifest matches.
+                if (exported_threads.get(cid) == thread_updated_ms or
+                        existing.stat().st_mtime * 1000 >= thread_updated_ms):
+                    exported_threads[cid] = thread_updated_ms
                     exported_count += 1
                     continue
             needs_export.append((cid, thread_data))
 
-        bubbles_by_cid = get_bubbles_batch(conn, {cid for cid, _ in needs_export})
+        bubbles_by_cid, contexts_by_cid = scan_disk_kv(conn, {cid for cid, _ in needs_export})
 
+        jobs = []  # write_conversation_markdown() arguments per thread
         for cid, thread_data in needs_export:
             bubbles = bubbles_by_cid.get(cid, [])
 
@@ -1078,40 +1382,52 @@ def export_conversations(output_dir: str, verbose: bool = False, min_timestamp_m
                     print(f"Skipping empty thread: {cid}")
                 continue
 
-            # Get first message for filename
-            first_content = ""
-            for bubble in bubbles:
-                content = extract_message_content(bubble)
-                if content.strip():
-                    first_content = content
-                    break
+            jobs.append((output_path, thread_data, cid, bubbles, contexts_by_cid.get(cid, {})))
 
-            if not first_content:
-                if verbose:
-                    print(f"Skipping thread with no content: {cid}")
-                continue
-
-            # Generate filename and content
-            filename = generate_filename(thread_data, cid, first_content)
-            file_path = output_path / filename
+        # Formatting is CPU-bound pure Python, so fan it out across processes.
+        # Results are collected in submission order to keep output deterministic.
+        workers = min(available_cpu_count(), len(jobs))
+        executor = None
+        if workers > 1 and len(jobs) >= PARALLEL_EXPORT_MIN_THREADS:
+            executor = ProcessPoolExecutor(max_workers=workers)
+        results = []
+        try:
+            if executor is not None:
+                for args in jobs:
+                    results.append(executor.submit(write_conversation_markdown, *args))
+            else:
+                results = [None] * len(jobs)
 
-            markdown_content = format_conversation_markdown(
-                thread_data, cid, bubbles, filename, conn)
+            for args, future in zip(jobs, results):
+                _, thread_data, cid, _, _ = args
+                try:
+                    filename = write_conversation_markdown(*args) if future is None else future.result()
+                    if not filename:
+                        if verbose:
+                            print(f"Skipping thread with no content: {cid}")
+                        continue
 
-            # Write file
-            try:
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    f.write(markdown_content)
+                    exported_threads[cid] = thread_data.get('lastUpdatedAt', thread_data.get('createdAt', 0))
+                    exported_count += 1
 
-                existing_by_cid[cid_short] = file_path
-                exported_count += 1
+                    if verbose:
+                        thread_name = thread_data.get('name', 'Untitled')
+                        print(f"Exported: {thread_name} -> {filename}")
 
-                if verbose:
-                    thread_name = thread_data.get('name', 'Untitled')
-                    print(f"Exported: {thread_name} -> {filename}")
+                except Exception as e:
+                    print(f"Error exporting {cid}: {e}")
+        finally:
+            if executor is not None:
+                # Also reached on KeyboardInterrupt; don't start queued jobs.
+                # shutdown(cancel_futures=True) would need Python 3.9.
+                for future in results:
+                    future.cancel()
+                executor.shutdown()
 
-            except Exception as e:
-                print(f"Error writing {filename}: {e}")
+        try:
+            save_export_manifest(output_path, manifest)
+        except OSError as e:
+            print(f"Error writing {EXPORT_MANIFEST_NAME}: {e}")
 
         # Export terminal history as a separate file
         export_terminal_history(output_path, conn, verbose)
@@ -1125,21 +1441,27 @@ def export_conversations(output_dir: str, verbose: bool = False, min_timestamp_m
 def generate_file_modification_timeline(output_path: Path, conn: sqlite3.Connection, verbose: bool = False) -> None:
     """Generate a timeline of file modifications across all conversations."""
     try:
-        # Track file modifications: {file_path: [(timestamp, cid, thread_name, action, details)]}
+        # Track file modifications: {file_path: {'latest': timestamp, 'mods': [modification]}}
         file_timeline = {}
 
-        threads = get_composer_threads(conn)
+        # Read both in one transaction so they see the same snapshot even if
+        # Cursor commits to its WAL in between
+        conn.execute('BEGIN')
+        try:
+            threads = get_composer_threads(conn)
+            bubbles_by_cid = get_bubbles_batch(conn, {cid for cid, _ in threads})
+        finally:
+            conn.rollback()
 
         for cid, thread_data in threads:
             thread_name = thread_data.get('name', 'Untitled')
             created_at = thread_data.get('createdAt', 0)
-            timestamp_str = datetime.fromtimestamp(
-                created_at / 1000).strftime('%Y-%m-%d %H:%M')
+            timestamp_str = format_timestamp(created_at, '%Y-%m-%d %H:%M')
 
-            bubbles = get_thread_bubbles(conn, cid)
+            bubbles = bubbles_by_cid.get(cid, [])
 
             for bubble in bubbles:
-                tool_former_data = bubble.get('toolFormerData', {})
+                tool_former_data = bubble.get('toolFormerData') or EMPTY_DICT
                 if not isinstance(tool_former_data, dict):
                     continue
 
@@ -1148,7 +1470,7 @@ def generate_file_modification_timeline(output_path: Path, conn: sqlite3.Connect
                 # Parse arguments
                 raw_args = tool_former_data.get('rawArgs', '')
                 try:
-                    args = json.loads(raw_args) if raw_args else {}
+                    args = json_loads(raw_args) if raw_args else {}
                 except json.JSONDecodeError:
                     continue
 
@@ -1161,7 +1483,7 @@ def generate_file_modification_timeline(output_path: Path, conn: sqlite3.Connect
                     file_path = args.get('file_path', '')
                     action = 'Created/Overwritten'
                     contents = args.get('contents', '')
-                    line_count = len(contents.split('\n')) if contents else 0
+                    line_count = contents.count('\n') + 1 if contents else 0
                     details.append(f"{line_count} lines")
 
                 elif tool_name == 'search_replace':
@@ -1216,10 +1538,13 @@ def generate_file_modification_timeline(output_path: Path, conn: sqlite3.Connect
 
                 # Record modification
                 if file_path and action:
-                    if file_path not in file_timeline:
-                        file_timeline[file_path] = []
+                    entry = file_timeline.get(file_path)
+                    if entry is None:
+                        entry = file_timeline[file_path] = {'latest': created_at, 'mods': []}
+                    elif created_at > entry['latest']:
+                        entry['latest'] = created_at
 
-                    file_timeline[file_path].append({
+                    entry['mods'].append({
                         'timestamp': created_at,
                         'timestamp_str': timestamp_str,
                         'cid': cid[:8],
@@ -1242,23 +1567,24 @@ def generate_file_modification_timeline(output_path: Path, conn: sqlite3.Connect
             ""
         ]
 
-        # Sort files by most recent modification
+        # Sort files by most recent modification, tracked as they were recorded
         sorted_files = sorted(
             file_timeline.items(),
-            key=lambda x: max(m['timestamp'] for m in x[1]),
+            key=lambda x: x[1]['latest'],
             reverse=True
         )
 
-        for file_path, modifications in sorted_files:
+        for file_path, entry in sorted_files:
+            modifications = entry['mods']
             # Sort modifications chronologically
-            sorted_mods = sorted(modifications, key=lambda x: x['timestamp'])
+            modifications.sort(key=lambda x: x['timestamp'])
 
             md_lines.append(f"## `{file_path}`")
             md_lines.append("")
             md_lines.append(f"**Total modifications:** {len(modifications)}")
             md_lines.append("")
 
-            for mod in sorted_mods:
+            for mod in modifications:
                 detail_str = ' — '.join(
                     mod['details']) if mod['details'] else ''
                 if detail_str:
@@ -1289,22 +1615,16 @@ def generate_file_modification_timeline(output_path: Path, conn: sqlite3.Connect
 def export_terminal_history(output_path: Path, conn: sqlite3.Connection, verbose: bool = False) -> None:
     """Export terminal command history to a separate file."""
     try:
-        # Connect to ItemTable to get terminal history
-        item_conn = connect_db_readonly(get_global_cursor_db_path())
-        cursor = item_conn.cursor()
-
-        # Get terminal commands
-        cursor.execute(
-            "SELECT value FROM ItemTable WHERE key = 'terminal.history.entries.commands'")
-        commands_result = cursor.fetchone()
-
-        # Get terminal directories
-        cursor.execute(
-            "SELECT value FROM ItemTable WHERE key = 'terminal.history.entries.dirs'")
-        dirs_result = cursor.fetchone()
-
-        if commands_result and commands_result[0]:
-            commands_data = json.loads(commands_result[0])
+        # conn is already open on the global DB, which also holds ItemTable;
+        # fetch terminal commands and directories in one query
+        history = dict(conn.execute(
+            "SELECT key, value FROM ItemTable WHERE key IN (?, ?)",
+            ('terminal.history.entries.commands', 'terminal.history.entries.dirs')))
+        commands_value = history.get('terminal.history.entries.commands')
+        dirs_value = history.get('terminal.history.entries.dirs')
+
+        if commands_value:
+            commands_data = json_loads(commands_value)
             commands = commands_data.get('entries', [])
 
             # Generate terminal history markdown
@@ -1319,11 +1639,13 @@ def export_terminal_history(output_path: Path, conn: sqlite3.Connection, verbose
             ]
 
             # Add commands (showing most recent first)
-            # Last 50 commands
-            for i, cmd_entry in enumerate(reversed(commands[-50:])):
+            # Last 50 commands, walked by index rather than a reversed slice copy
+            start = max(0, len(commands) - 50)
+            for number, i in enumerate(range(len(commands) - 1, start - 1, -1), start + 1):
+                cmd_entry = commands[i]
                 if isinstance(cmd_entry, dict):
                     command = cmd_entry.get('key', '')
-                    shell_info = cmd_entry.get('value', {})
+                    shell_info = cmd_entry.get('value')
                     shell_type = shell_info.get('shellType', 'unknown') if isinstance(
                         shell_info, dict) else 'unknown'
 
@@ -1332,19 +1654,19 @@ def export_terminal_history(output_path: Path, conn: sqlite3.Connection, verbose
                         # Multi-line command - format nicely
                         clean_cmd = command.replace('\\n', ' \\\\\n    ')
                         md_lines.append(
-                            f"### Command {len(commands)-len(commands[-50:])+i+1} ({shell_type})")
+                            f"### Command {number} ({shell_type})")
                         md_lines.append("```bash")
                         md_lines.append(clean_cmd)
                         md_lines.append("```")
                     else:
                         # Single line command
                         md_lines.append(
-                            f"**{len(commands)-len(commands[-50:])+i+1}.** `{command}` ({shell_type})")
+                            f"**{number}.** `{command}` ({shell_type})")
                     md_lines.append("")
 
             # Add directory history if available
-            if dirs_result and dirs_result[0]:
-                dirs_data = json.loads(dirs_result[0])
+            if dirs_value:
+                dirs_data = json_loads(dirs_value)
                 dirs = dirs_data.get('entries', [])
 
                 if dirs:
@@ -1353,11 +1675,13 @@ def export_terminal_history(output_path: Path, conn: sqlite3.Connection, verbose
                         ""
                     ])
 
-                    # Last 20 directories
-                    for i, dir_entry in enumerate(reversed(dirs[-20:])):
+                    # Last 20 directories, numbered from the most recent
+                    start = max(0, len(dirs) - 20)
+                    for rank, i in enumerate(range(len(dirs) - 1, start - 1, -1), 1):
+                        dir_entry = dirs[i]
                         if isinstance(dir_entry, dict):
                             directory = dir_entry.get('key', '')
-                            md_lines.append(f"**{i+1}.** `{directory}`")
+                            md_lines.append(f"**{rank}.** `{directory}`")
                     md_lines.append("")
 
             # Write terminal history file
@@ -1369,13 +1693,116 @@ def export_terminal_history(output_path: Path, conn: sqlite3.Connection, verbose
                 print(
                     f"Exported terminal history: terminal-history.md ({len(commands)} commands)")
 
-        item_conn.close()
-
     except Exception as e:
         if verbose:
             print(f"Error exporting terminal history: {e}")
 
 
+def release_lock(lock_path: str) -> None:
+    """Remove the PID lock file if it is still present."""
+    try:
+        os.unlink(lock_path)
+    except FileNotFoundError:
+        pass
+
+
+def pid_is_running(pid: int) -> bool:
+    """Return True if a process with this PID exists.
+
+    On Windows os.kill(pid, 0) would terminate the process, so the Win32 API
+    is queried there instead.
+    """
+    if sys.platform == 'win32':
+        import ctypes
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        kernel32.OpenProcess.restype = ctypes.c_void_p
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return ctypes.get_last_error() == 5  # ERROR_ACCESS_DENIED: exists, not ours
+        try:
+            exit_code = ctypes.c_ulong()
+            if not kernel32.GetExitCodeProcess(ctypes.c_void_p(handle), ctypes.byref(exit_code)):
+                return True
+            return exit_code.value == 259  # STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(ctypes.c_void_p(handle))
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # Running as another user
+    return True
+
+
+def reclaim_stale_lock(lock_path: str, stale_id: Tuple[int, int, int]) -> None:
+    """Remove a stale lock file, unless another instance has replaced it.
+
+    stale_id is (st_dev, st_ino, st_mtime_ns) of the file judged stale. The
+    file is renamed aside first, which is atomic: of several instances
+    reclaiming the same lock only one moves it. If what was moved is not the
+    stale file, another instance already took a fresh lock, so it is linked
+    back into place. Raises PermissionError if the lock can't be moved.
+    """
+    aside = f"{lock_path}.{os.getpid()}.stale"
+    try:
+        os.rename(lock_path, aside)
+    except FileNotFoundError:
+        return  # Already reclaimed by another instance
+    try:
+        st = os.stat(aside)
+        if (st.st_dev, st.st_ino, st.st_mtime_ns) != stale_id:
+            try:
+                os.link(aside, lock_path)  # Fails instead of clobbering a newer lock
+            except OSError:
+                pass  # A newer lock exists, or the filesystem has no hard links
+    finally:
+        os.unlink(aside)
+
+
+def acquire_lock(lock_path: str) -> bool:
+    """Take a PID-file lock, returning False if another live instance holds it.
+
+    The lock file is created atomically with O_EXCL and removed at exit. A lock
+    left behind by a process that no longer exists is reclaimed once.
+    """
+    for _ in range(2):
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            try:
+                with open(lock_path, encoding='utf-8') as f:
+                    pid_text = f.read().strip()
+                    st = os.fstat(f.fileno())
+            except FileNotFoundError:
+                continue  # Holder exited between our open() calls
+
+            if not pid_text:
+                if datetime.now().timestamp() - st.st_mtime < LOCK_PID_WRITE_GRACE:
+                    return False  # Holder is still writing its PID
+            elif (pid_text.isdigit() and int(pid_text) != os.getpid()
+                  and pid_is_running(int(pid_text))):
+                # Our own PID can only be left by an earlier run that crashed
+                # (PIDs repeat across runs in containers and cron sandboxes)
+                return False  # Holder is still running
+
+            # Stale lock from a crashed run
+            try:
+                reclaim_stale_lock(lock_path, (st.st_dev, st.st_ino, st.st_mtime_ns))
+            except PermissionError as e:
+                print(f"export-cursor: cannot remove stale lock {lock_path}: {e}", file=sys.stderr)
+                return False
+            continue
+        try:
+            os.write(fd, str(os.getpid()).encode())
+        finally:
+            os.close(fd)
+        atexit.register(release_lock, lock_path)
+        return True
+    return False
+
+
 def main():
     """Main entry point."""
     parser = argparse.ArgumentParser(
@@ -1395,10 +1822,7 @@ def main():
 if __name__ == '__main__':
     import time as _time
 
-    _lock_fd = open(LOCK_FILE, 'w')
-    try:
-        fcntl.flock(_lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
-    except OSError:
+    if not acquire_lock(LOCK_FILE):
         print("export-cursor: another instance is already running, exiting")
         sys.exit(0)
 